@@ -6,9 +6,18 @@ import uuid
 from forex_python.converter import CurrencyRates
 import json
 import os.path
+import heapq
+import tempfile
+import unicodedata
+from collections import Counter
+from itertools import accumulate
 
 c = CurrencyRates()
 useFXRates = False
+# delta rows kept in memory, once reached they are sorted and spilled to a temporary file
+deltaRowBudget = 100000
+# spilled runs open at once, once reached they are merged into a single run
+deltaMergeFanIn = 64
 
 # TODO cleanup a lot pls
 fxRateCache = {}
@@ -16,6 +25,86 @@ if os.path.isfile("ratesCache.txt"):
     with open("ratesCache.txt", "r") as file:
         fxRateCache = json.loads(file.read())
 
+# transaction types of each broker mapped to the action handling them,
+# more labels can be added (or existing ones remapped) in transactionTypes.json
+transactionTypes = {
+    "revolut": {
+        "DIVIDEND": "dividend",
+        "DIVIDEND TAX (CORRECTION)": "withheld_tax",
+        "CASH TOP-UP": "deposit",
+        "CASH WITHDRAWAL": "withdrawal",
+        "CUSTODY FEE": "fee",
+        "BUY - MARKET": "buy",
+        "STOCK SPLIT": "split",
+        "SELL - MARKET": "sell",
+    },
+    "xtb": {
+        "Dividend": "dividend",
+        "DIVIDENT": "dividend",
+        "spin-off": "spin_off",
+        "Withholding tax": "withheld_tax",
+        "Withholding Tax": "withheld_tax",
+        "Impozitul reținut": "withheld_tax",
+        "Stamp duty": "stamp_duty",
+        "Stamp Duty": "stamp_duty",
+        "Free-funds Interest": "interest",
+        "Free-funds Interest Tax": "interest_tax",
+        "Deposit": "deposit",
+        "Depunere": "deposit",
+        "deposit": "withdrawal",
+        "tax RO": "fee",
+        "SEC fee": "fee",
+        "Sec Fee": "fee",
+        "Stocks/ETF purchase": "buy",
+        "Acțiuni/Cumpărare ETF": "buy",
+        "Stock purchase": "buy",
+        "Profit/Loss": "ignore",
+        "Stocks/ETF sale": "ignore",
+        "Vânzare acțiuni /ETF-uri": "ignore",
+        "Profit/Pierdere": "ignore",
+        "Stock sale": "ignore",
+        "close trade": "ignore",
+    },
+    "etoro": {
+        "Dividend": "dividend",
+        "Interest Payment": "interest",
+        "Deposit": "deposit",
+        "Open Position": "open_position",
+        "Position closed": "close_position",
+        "Overnight fee": "fee",
+        "Start Copy": "ignore",
+        "Stop Copy": "ignore",
+        "corp action: Split": "ignore",
+        "Adjustment": "ignore",
+    },
+}
+if os.path.isfile("transactionTypes.json"):
+    with open("transactionTypes.json", "r", encoding="utf-8") as file:
+        for broker, types in json.loads(file.read()).items():
+            transactionTypes.setdefault(broker, {}).update(types)
+
+# tax summary category of the xtb actions kept in the dividends sheet,
+# interest is declared apart from dividends and spin-off shares are not dividend income
+xtbTaxCategories = {
+    "dividend": "dividends",
+    "interest": "interest",
+    "spin_off": "spin_off",
+    "withheld_tax": "withheld_tax",
+    "interest_tax": "withheld_tax",
+    "stamp_duty": "taxes_comissions",
+}
+
+# direction in which the etoro actions move the cash balance, the other rows take the broker reported change
+etoroCashFlows = {
+    "dividend": 1,
+    "interest": 1,
+    "deposit": 1,
+    "fee": 1,
+    "open_position": -1,
+    "close_position": 1,
+}
+# difference allowed between the derived and the broker reported balance
+balanceTolerance = 0.01
 
 ignore = True
 etoroList = [
@@ -36,6 +125,102 @@ etoroList = [
 ]
 
 
+# XTB sheet columns, mapped to the header names they can have in the export
+xtbCashOpColumns = {
+    "type": ["Type", "Tip"],
+    "time": ["Time", "Ora", "Data"],
+    "comment": ["Comment", "Comentariu"],
+    "symbol": ["Symbol", "Simbol"],
+    "amount": ["Amount", "Sumă", "Suma"],
+}
+xtbClosedOpColumns = {
+    "symbol": ["Symbol", "Simbol"],
+    "volume": ["Volume", "Volum"],
+    "openTime": ["Open time", "Ora deschiderii"],
+    "closeTime": ["Close time", "Ora închiderii"],
+    "openValue": ["Purchase value", "Valoarea de achiziție"],
+    "closeValue": ["Sale value", "Valoarea de vânzare"],
+}
+# layout of the exports before header detection, used when no header is found
+xtbCashOpLegacyLayout = (
+    11,
+    {"type": 2, "time": 3, "comment": 4, "symbol": 5, "amount": 6},
+)
+xtbClosedOpLegacyLayout = (
+    13,
+    {
+        "symbol": 2,
+        "volume": 4,
+        "openTime": 5,
+        "closeTime": 7,
+        "openValue": 11,
+        "closeValue": 12,
+    },
+)
+xtbHeaderSearchRows = 50
+xtbFooterLabels = ["total"]
+xtbBalanceLabels = ["Balance", "Sold"]
+
+
+def findHeader(sheet, columns: dict, legacyLayout: tuple):
+    # look for the first row containing all the column names, return it and the column indexes
+    aliases = {
+        alias.strip().lower(): column
+        for column, names in columns.items()
+        for alias in names
+    }
+    for row in sheet.iter_rows(1, min(xtbHeaderSearchRows, sheet.max_row)):
+        columnMap = {}
+        for cell in row:
+            if isinstance(cell.value, str) and cell.value.strip().lower() in aliases:
+                columnMap.setdefault(
+                    aliases[cell.value.strip().lower()], cell.column - 1
+                )
+        if len(columnMap) == len(columns):
+            return row[0].row, columnMap
+    print(f"WARN: No header found in sheet '{sheet.title}', using the default layout")
+    return legacyLayout
+
+
+def findReportedBalance(sheet, headerRow: int, labels: list):
+    # the account summary above the table has the labels on a row and the values on the next one
+    if headerRow <= 1:
+        return None
+    labels = [label.lower() for label in labels]
+    for row in sheet.iter_rows(1, headerRow - 1):
+        for cell in row:
+            if isinstance(cell.value, str) and cell.value.strip().lower() in labels:
+                balance = sheet.cell(cell.row + 1, cell.column).value
+                if isinstance(balance, (int, float)):
+                    return balance
+    return None
+
+
+def iterTableRows(sheet, headerRow: int):
+    # yield the data rows under the header, stop at the end of the table (an empty row or the total footer),
+    # rows with bad values are still yielded so their handler reports them
+    for row in sheet.iter_rows(headerRow + 1, sheet.max_row):
+        values = [
+            cell.value for cell in row if cell.value is not None and cell.value != ""
+        ]
+        if len(values) == 0:
+            return
+        if any(
+            isinstance(value, str) and value.strip().lower() in xtbFooterLabels
+            for value in values
+        ):
+            return
+        yield row
+
+
+def normalizeTransactType(transactType):
+    # collapse whitespace and use the comma below romanian letters instead of the cedilla ones
+    if not isinstance(transactType, str):
+        return transactType
+    transactType = unicodedata.normalize("NFC", " ".join(transactType.split()))
+    return transactType.translate(str.maketrans("şţŞŢ", "șțȘȚ"))
+
+
 def etoroDateToDateTime(value: str) -> datetime.datetime:
     return datetime.datetime.strptime(value, "%d/%m/%Y %H:%M:%S")
 
@@ -61,7 +246,65 @@ class InvestmentParser:
             "taxes_comissions": [],
             "intermediarySales": {},
             "deltaRows": [],
+            "deltaRuns": [],
+            "cashEvents": [],
+            "balanceCheckpoints": [],
+            "openingBalance": None,
         }
+        # running tax totals, keyed by (year, company, category) and (year, category)
+        self.taxIndex = {}
+        self.taxYearTotals = {}
+        self.missingFxRateDates = set()
+        # actions of each broker mapped to the method handling them
+        transactionHandlers = {
+            "revolut": {
+                "dividend": self.handleRevolutDividend,
+                "withheld_tax": self.handleRevolutDividend,
+                "deposit": self.handleRevolutDeposit,
+                "withdrawal": self.handleRevolutDeposit,
+                "fee": self.handleRevolutFee,
+                "buy": self.handleRevolutBuy,
+                "split": self.handleRevolutBuy,
+                "sell": self.handleRevolutSell,
+                "ignore": self.skipTransaction,
+            },
+            "xtb": {
+                "dividend": self.handleXtbDividend,
+                "spin_off": self.handleXtbDividend,
+                "withheld_tax": self.handleXtbDividend,
+                "stamp_duty": self.handleXtbDividend,
+                "interest": self.handleXtbDividend,
+                "interest_tax": self.handleXtbDividend,
+                "deposit": self.handleXtbDeposit,
+                "withdrawal": self.handleXtbDeposit,
+                "fee": self.handleXtbFee,
+                "buy": self.handleXtbBuy,
+                "ignore": self.skipTransaction,
+            },
+            "etoro": {
+                "dividend": self.handleEtoroDividend,
+                "interest": self.handleEtoroDividend,
+                "deposit": self.handleEtoroDeposit,
+                "open_position": self.handleEtoroPosition,
+                "close_position": self.handleEtoroPosition,
+                "fee": self.handleEtoroFee,
+                "ignore": self.skipTransaction,
+            },
+        }.get(type, {})
+        # compile the normalized transaction types of the broker to their (action, handler)
+        self.transactionDispatch = {}
+        for transactType, action in transactionTypes.get(type, {}).items():
+            if action not in transactionHandlers:
+                print(
+                    f"WARN: Unknown action '{action}' for transaction type '{transactType}'"
+                )
+                continue
+            self.transactionDispatch[normalizeTransactType(transactType)] = (
+                action,
+                transactionHandlers[action],
+            )
+        self.transactionLabelCache = {}
+        self.unknownTransactTypes = Counter()
 
     def getFxRate(self, transactDate: datetime.datetime):
         dateString = transactDate.strftime("%Y_%m_%d")
@@ -73,6 +316,48 @@ class InvestmentParser:
             print(f"Loaded FX Rate for {dateString}")
         return fxRateCache[dateString]
 
+    def addToTaxIndex(
+        self,
+        transactDate: datetime.datetime,
+        company: str,
+        category: str,
+        value: float,
+        valueRon: float = None,
+    ):
+        # without a known fx rate the ron value of the whole group is left empty
+        if valueRon is None and (
+            useFXRates or transactDate.strftime("%Y_%m_%d") in fxRateCache
+        ):
+            valueRon = self.getFxRate(transactDate) * value
+        if valueRon is None:
+            self.missingFxRateDates.add(transactDate.strftime("%Y-%m-%d"))
+        for key, index in [
+            ((transactDate.year, company, category), self.taxIndex),
+            ((transactDate.year, category), self.taxYearTotals),
+        ]:
+            if key not in index:
+                index[key] = {"value": 0, "value_ron": 0}
+            index[key]["value"] += value
+            if valueRon is None or index[key]["value_ron"] is None:
+                index[key]["value_ron"] = None
+            else:
+                index[key]["value_ron"] += valueRon
+
+    def classifyTransaction(self, transactType):
+        # each raw label is normalized only the first time it is seen
+        if transactType not in self.transactionLabelCache:
+            self.transactionLabelCache[transactType] = self.transactionDispatch.get(
+                normalizeTransactType(transactType)
+            )
+        transaction = self.transactionLabelCache[transactType]
+        if transaction is None:
+            self.unknownTransactTypes[transactType] += 1
+        return transaction
+
+    def skipTransaction(self, transactRow: dict):
+        # nothing to do yet
+        pass
+
     def initResultXls(self):
         self.resultXls = Workbook()
         sheet = self.resultXls.active
@@ -84,19 +369,70 @@ class InvestmentParser:
         self.resultXls.create_sheet("Sales")
         # create sheet for taxes/comissions
         self.resultXls.create_sheet("Taxes+Comissions")
+        # create sheet for the yearly tax summary
+        self.resultXls.create_sheet("Tax Summary")
 
     def parse(self):
-        if self.type == "xtb":
-            self.parseXtb()
-        elif self.type == "etoro":
-            self.parseEtoro()
-        elif self.type == "revolut":
-            self.parseRevolut()
-        else:
+        try:
+            if self.type == "xtb":
+                self.parseXtb()
+            elif self.type == "etoro":
+                self.parseEtoro()
+            elif self.type == "revolut":
+                self.parseRevolut()
+            else:
+                print(
+                    f"ERR: Wrong type of file, expected 'xtb', 'etoro', 'revolut', got '{self.type}'\n"
+                )
+                return
+        finally:
+            self.closeDeltaRuns()
+
+        self.reconcileCashBalance()
+
+        if self.unknownTransactTypes:
             print(
-                f"ERR: Wrong type of file, expected 'xtb', 'etoro', 'revolut', got '{self.type}'\n"
+                "WARN: Unknown transaction types: "
+                + ", ".join(
+                    f"{transactType} ({count} rows)"
+                    for transactType, count in self.unknownTransactTypes.most_common()
+                )
             )
 
+    def reconcileCashBalance(self):
+        # compare the cash balance derived from the handled rows with the one reported by the broker
+        checkpoints = self.cacheDict["balanceCheckpoints"]
+        openingBalance = self.cacheDict["openingBalance"]
+        if len(checkpoints) == 0 or openingBalance is None:
+            return
+        events = sorted(
+            self.cacheDict["cashEvents"], key=lambda event: event["fullDate"]
+        )
+        # derived and reported balance at the end of each day
+        derivedByDay = {}
+        for event, balance in zip(
+            events, accumulate(event["value"] for event in events)
+        ):
+            derivedByDay[event["fullDate"].date()] = openingBalance + balance
+        reportedByDay = {}
+        for checkpoint in sorted(
+            checkpoints, key=lambda checkpoint: checkpoint["fullDate"]
+        ):
+            reportedByDay[checkpoint["fullDate"].date()] = checkpoint["balance"]
+
+        derivedBalance = openingBalance
+        for day in sorted(derivedByDay.keys() | reportedByDay.keys()):
+            derivedBalance = derivedByDay.get(day, derivedBalance)
+            if (
+                day in reportedByDay
+                and abs(derivedBalance - reportedByDay[day]) > balanceTolerance
+            ):
+                print(
+                    f"WARN: Cash balance diverges from the broker on {day}: "
+                    f"derived {derivedBalance:.2f}, reported {reportedByDay[day]:.2f}"
+                )
+                return
+
     ################# REVOLUT ##########################
     def parseRevolut(self):
         # Define variable to load the dataframe
@@ -136,123 +472,139 @@ class InvestmentParser:
         # else:
         #     totalValue = totalValueStr
 
-        if transactType in ["DIVIDEND", "DIVIDEND TAX (CORRECTION)"]:
-            self.cacheDict["dividends"].append(
-                {
-                    "date": transactDate,
-                    "fullDate": transactFullDate,
-                    "company": transactSymbol,
-                    "value": totalValue,
-                }
-            )
-            self.cacheDict["deltaRows"].append(
-                {
-                    "action": "DIVIDEND",
-                    "amount": "",
-                    "fullDate": transactFullDate,
-                    "company": transactSymbol,
-                    "value": totalValue,
-                    "type": "STOCK",
-                }
-            )
-        elif transactType in ["CASH TOP-UP", "CASH WITHDRAWAL"]:
-            if (
-                len(self.cacheDict["deposits"]) > 0
-                and self.cacheDict["deposits"][-1]["date"] == transactDate
-            ):
-                self.cacheDict["deposits"][-1]["value"] += totalValue
-                self.cacheDict["deposits"][-1]["value_ron"] += (1 / fxRate) * totalValue
-            else:
-                self.cacheDict["deposits"].append(
-                    {
-                        "date": transactDate,
-                        "value_ron": (1 / fxRate) * totalValue,
-                        "value": totalValue,
-                    }
-                )
-            self.cacheDict["deltaRows"].append(
-                {
-                    "action": (
-                        "DEPOSIT" if transactType == "CASH TOP-UP" else "WITHDRAW"
-                    ),
-                    "amount": (
-                        totalValue if transactType == "CASH TOP-UP" else -totalValue
-                    ),
-                    "fullDate": transactFullDate,
-                    "company": "USD",
-                    "value": "",
-                    "type": "FIAT",
-                }
-            )
-        elif transactType in ["CUSTODY FEE"]:
-            self.cacheDict["taxes_comissions"].append(
+        transaction = self.classifyTransaction(transactType)
+        if transaction is None:
+            return
+        action, handler = transaction
+        handler(
+            {
+                "action": action,
+                "type": transactType,
+                "date": transactDate,
+                "fullDate": transactFullDate,
+                "symbol": transactSymbol,
+                "quantity": transactQuantity,
+                "value": totalValue,
+                "fxRate": fxRate,
+            }
+        )
+
+    def handleRevolutDividend(self, transactRow: dict):
+        action = transactRow["action"]
+        transactDate = transactRow["date"]
+        transactFullDate = transactRow["fullDate"]
+        transactSymbol = transactRow["symbol"]
+        totalValue = transactRow["value"]
+        fxRate = transactRow["fxRate"]
+        self.cacheDict["dividends"].append(
+            {
+                "date": transactDate,
+                "fullDate": transactFullDate,
+                "company": transactSymbol,
+                "value": totalValue,
+            }
+        )
+        self.addToTaxIndex(
+            transactDate,
+            transactSymbol,
+            "dividends" if action == "dividend" else "withheld_tax",
+            totalValue,
+            (1 / fxRate) * totalValue,
+        )
+        self.addDeltaRow(
+            {
+                "action": "DIVIDEND",
+                "amount": "",
+                "fullDate": transactFullDate,
+                "company": transactSymbol,
+                "value": totalValue,
+                "type": "STOCK",
+            }
+        )
+
+    def handleRevolutDeposit(self, transactRow: dict):
+        action = transactRow["action"]
+        transactDate = transactRow["date"]
+        transactFullDate = transactRow["fullDate"]
+        totalValue = transactRow["value"]
+        fxRate = transactRow["fxRate"]
+        if (
+            len(self.cacheDict["deposits"]) > 0
+            and self.cacheDict["deposits"][-1]["date"] == transactDate
+        ):
+            self.cacheDict["deposits"][-1]["value"] += totalValue
+            self.cacheDict["deposits"][-1]["value_ron"] += (1 / fxRate) * totalValue
+        else:
+            self.cacheDict["deposits"].append(
                 {
                     "date": transactDate,
+                    "value_ron": (1 / fxRate) * totalValue,
                     "value": totalValue,
-                    "type": "monthly fee",
-                    "moreInfo": transactType,
                 }
             )
-            self.cacheDict["deltaRows"].append(
-                {
-                    "action": "WITHDRAW",
-                    "amount": -totalValue,
-                    "fullDate": transactFullDate,
-                    "company": "USD",
-                    "value": "",
-                    "type": "FIAT",
-                }
-            )
-        elif transactType in [
-            "BUY - MARKET",
-            "STOCK SPLIT",
-        ]:  # stock splits tell the delta after the split (unfortunatley negative deltas seem to be wrongly reported by revolut as positive)
-            if transactSymbol not in self.cacheDict["intermediarySales"]:
-                self.cacheDict["intermediarySales"][transactSymbol] = {
-                    "count": 0,
-                    "value": 0,
-                    "firstDate": transactDate,
-                }
-            self.cacheDict["intermediarySales"][transactSymbol][
-                "count"
-            ] += transactQuantity
-            self.cacheDict["intermediarySales"][transactSymbol]["value"] += totalValue
-            if transactType in ["BUY - MARKET"]:
-                self.cacheDict["deltaRows"].append(
-                    {
-                        "action": "BUY",
-                        "amount": transactQuantity,
-                        "fullDate": transactFullDate,
-                        "company": transactSymbol,
-                        "value": totalValue,
-                        "type": "STOCK",
-                    }
-                )
-        elif transactType in ["SELL - MARKET"]:
-            # we have to do some calculations
-            knownInfo = self.cacheDict["intermediarySales"][transactSymbol]
-            # calculate open value as an average of all the open positions
-            openValue = knownInfo["value"] / knownInfo["count"] * transactQuantity
-            # update known values
-            self.cacheDict["intermediarySales"][transactSymbol][
-                "count"
-            ] -= transactQuantity
-            self.cacheDict["intermediarySales"][transactSymbol]["value"] -= openValue
-            # add info
-            self.cacheDict["sales"].append(
-                {
-                    "dateOpen": self.cacheDict["intermediarySales"][transactSymbol][
-                        "firstDate"
-                    ],  # this cannot be decided from revolut, so mark with empty
-                    "dateClose": transactDate,
-                    "company": transactSymbol,
-                    "openValue": openValue,
-                    "closeValue": totalValue,
-                }
-            )
-            self.cacheDict["deltaRows"].append(
+        self.addDeltaRow(
+            {
+                "action": ("DEPOSIT" if action == "deposit" else "WITHDRAW"),
+                "amount": (totalValue if action == "deposit" else -totalValue),
+                "fullDate": transactFullDate,
+                "company": "USD",
+                "value": "",
+                "type": "FIAT",
+            }
+        )
+
+    def handleRevolutFee(self, transactRow: dict):
+        transactType = transactRow["type"]
+        transactDate = transactRow["date"]
+        transactFullDate = transactRow["fullDate"]
+        totalValue = transactRow["value"]
+        fxRate = transactRow["fxRate"]
+        self.cacheDict["taxes_comissions"].append(
+            {
+                "date": transactDate,
+                "value": totalValue,
+                "type": "monthly fee",
+                "moreInfo": transactType,
+            }
+        )
+        self.addToTaxIndex(
+            transactDate,
+            "USD",
+            "taxes_comissions",
+            totalValue,
+            (1 / fxRate) * totalValue,
+        )
+        self.addDeltaRow(
+            {
+                "action": "WITHDRAW",
+                "amount": -totalValue,
+                "fullDate": transactFullDate,
+                "company": "USD",
+                "value": "",
+                "type": "FIAT",
+            }
+        )
+
+    def handleRevolutBuy(self, transactRow: dict):
+        action = transactRow["action"]
+        transactDate = transactRow["date"]
+        transactFullDate = transactRow["fullDate"]
+        transactSymbol = transactRow["symbol"]
+        transactQuantity = transactRow["quantity"]
+        totalValue = transactRow["value"]
+        # stock splits tell the delta after the split (unfortunatley negative deltas seem to be wrongly reported by revolut as positive)
+        if transactSymbol not in self.cacheDict["intermediarySales"]:
+            self.cacheDict["intermediarySales"][transactSymbol] = {
+                "count": 0,
+                "value": 0,
+                "firstDate": transactDate,
+            }
+        self.cacheDict["intermediarySales"][transactSymbol]["count"] += transactQuantity
+        self.cacheDict["intermediarySales"][transactSymbol]["value"] += totalValue
+        if action == "buy":
+            self.addDeltaRow(
                 {
-                    "action": "SELL",
+                    "action": "BUY",
                     "amount": transactQuantity,
                     "fullDate": transactFullDate,
                     "company": transactSymbol,
@@ -260,8 +612,50 @@ class InvestmentParser:
                     "type": "STOCK",
                 }
             )
-        else:
-            print(f"WARN: Unknown transaction type: {transactType}")
+
+    def handleRevolutSell(self, transactRow: dict):
+        transactDate = transactRow["date"]
+        transactFullDate = transactRow["fullDate"]
+        transactSymbol = transactRow["symbol"]
+        transactQuantity = transactRow["quantity"]
+        totalValue = transactRow["value"]
+        fxRate = transactRow["fxRate"]
+        # we have to do some calculations
+        knownInfo = self.cacheDict["intermediarySales"][transactSymbol]
+        # calculate open value as an average of all the open positions
+        openValue = knownInfo["value"] / knownInfo["count"] * transactQuantity
+        # update known values
+        self.cacheDict["intermediarySales"][transactSymbol]["count"] -= transactQuantity
+        self.cacheDict["intermediarySales"][transactSymbol]["value"] -= openValue
+        # add info
+        self.cacheDict["sales"].append(
+            {
+                "dateOpen": self.cacheDict["intermediarySales"][transactSymbol][
+                    "firstDate"
+                ],  # this cannot be decided from revolut, so mark with empty
+                "dateClose": transactDate,
+                "company": transactSymbol,
+                "openValue": openValue,
+                "closeValue": totalValue,
+            }
+        )
+        self.addToTaxIndex(
+            transactDate,
+            transactSymbol,
+            "sales",
+            totalValue - openValue,
+            (1 / fxRate) * (totalValue - openValue),
+        )
+        self.addDeltaRow(
+            {
+                "action": "SELL",
+                "amount": transactQuantity,
+                "fullDate": transactFullDate,
+                "company": transactSymbol,
+                "value": totalValue,
+                "type": "STOCK",
+            }
+        )
 
     ################# END REVOLUT ######################
 
@@ -273,21 +667,45 @@ class InvestmentParser:
 
         # Define variable to read sheet
         sheetCashOp = excelFile["CASH OPERATION HISTORY"]
+        headerRow, columns = findHeader(
+            sheetCashOp, xtbCashOpColumns, xtbCashOpLegacyLayout
+        )
 
-        # Iterate over the rows and col
-        for row in sheetCashOp.iter_rows(12, sheetCashOp.max_row):
-            self.handleXtbCashHistRow(row)
+        # Iterate over the rows of the table, keeping the last operation and the total of all amounts for the reconciliation
+        lastRow = None
+        tableTotal = 0
+        for row in iterTableRows(sheetCashOp, headerRow):
+            self.handleXtbCashHistRow(row, columns)
+            if isinstance(row[columns["amount"]].value, (int, float)):
+                tableTotal += row[columns["amount"]].value
+            if isinstance(row[columns["time"]].value, datetime.datetime) and (
+                lastRow is None or row[columns["time"]].value > lastRow
+            ):
+                lastRow = row[columns["time"]].value
+
+        # xtb only reports the balance at the end of the export, so there is a single check after the last operation.
+        # It reports no opening balance either, so it is derived from the table: this does not check the broker total,
+        # only that no cash operation with an amount was left out of the handled rows (unknown or unparsable ones)
+        balance = findReportedBalance(sheetCashOp, headerRow, xtbBalanceLabels)
+        if balance is not None and lastRow is not None:
+            self.cacheDict["balanceCheckpoints"].append(
+                {"fullDate": lastRow, "balance": balance}
+            )
+            self.cacheDict["openingBalance"] = balance - tableTotal
 
         # Define variable to read sheet
         sheetClosedOp = excelFile["CLOSED POSITION HISTORY"]
+        headerRow, columns = findHeader(
+            sheetClosedOp, xtbClosedOpColumns, xtbClosedOpLegacyLayout
+        )
 
-        # Iterate over the rows and col
-        for row in sheetClosedOp.iter_rows(14, sheetClosedOp.max_row):
-            self.handleXtbClosedOpRow(row)
+        # Iterate over the rows of the table
+        for row in iterTableRows(sheetClosedOp, headerRow):
+            self.handleXtbClosedOpRow(row, columns)
 
         ## Dividends for delta
         for row in self.cacheDict["dividends"]:
-            self.cacheDict["deltaRows"].append(
+            self.addDeltaRow(
                 {
                     "action": "DIVIDEND" if row["company"] != "DOBANDA" else "DEPOSIT",
                     "amount": "" if row["company"] != "DOBANDA" else row["value"],
@@ -308,17 +726,17 @@ class InvestmentParser:
 
         self.exportResult("xtb")
 
-    def handleXtbClosedOpRow(self, row):
+    def handleXtbClosedOpRow(self, row, columns: dict):
         try:
-            transactDateOpen = extractDateFromDateTime(row[5].value)
-            transactDateClose = extractDateFromDateTime(row[7].value)
-            transactFullDate = row[7].value
-            transactSymbol = row[2].value
-            volume = row[4].value
-            openValue = row[11].value
-            closeValue = row[12].value
-        except:
-            # maybe out of data range
+            transactDateOpen = extractDateFromDateTime(row[columns["openTime"]].value)
+            transactDateClose = extractDateFromDateTime(row[columns["closeTime"]].value)
+            transactFullDate = row[columns["closeTime"]].value
+            transactSymbol = row[columns["symbol"]].value
+            volume = row[columns["volume"]].value
+            openValue = row[columns["openValue"]].value
+            closeValue = row[columns["closeValue"]].value
+        except Exception as e:
+            print(f"WARN: Could not parse closed position on row {row[0].row}: {e}")
             return
 
         self.cacheDict["sales"].append(
@@ -330,6 +748,9 @@ class InvestmentParser:
                 "closeValue": closeValue,
             }
         )
+        self.addToTaxIndex(
+            transactDateClose, transactSymbol, "sales", closeValue - openValue
+        )
         companyTicker = deltaTickerHelper(transactSymbol)
 
         # if (
@@ -339,7 +760,7 @@ class InvestmentParser:
         # ):
         #     transactFullDate += datetime.timedelta(0, 1)
 
-        self.cacheDict["deltaRows"].append(
+        self.addDeltaRow(
             {
                 "action": "SELL",
                 "amount": volume,
@@ -351,116 +772,129 @@ class InvestmentParser:
             }
         )
 
-    def handleXtbCashHistRow(self, row):
+    def handleXtbCashHistRow(self, row, columns: dict):
         try:
-            transactType = row[2].value
-            transactDate = extractDateFromDateTime(row[3].value)
-            transactFullDate = row[3].value
-            transactComment = row[4].value
-            transactSymbol = row[5].value  # not all rows have a symbol
-            if transactType in [
-                "Free-funds Interest",
-                "Free-funds Interest Tax",
-            ]:
+            transactType = row[columns["type"]].value
+            transactDate = extractDateFromDateTime(row[columns["time"]].value)
+            transactFullDate = row[columns["time"]].value
+            transactComment = row[columns["comment"]].value
+            transactSymbol = row[columns["symbol"]].value  # not all rows have a symbol
+            value = row[columns["amount"]].value
+            transaction = self.classifyTransaction(transactType)
+            if transaction is None:
+                return
+            action, handler = transaction
+            if action in ["interest", "interest_tax"]:
                 transactSymbol = "DOBANDA"
-            if transactType == "spin-off":
+            elif action == "spin_off":
                 transactSymbol += " (spin-off)"
-            value = row[6].value
-        except:
-            # maybe out of data range
+        except Exception as e:
+            print(f"WARN: Could not parse cash operation on row {row[0].row}: {e}")
             return
 
-        if transactType in [
-            "Dividend",
-            "DIVIDENT",
-            "spin-off",
-            "Withholding tax",
-            "Withholding Tax",
-            "Stamp duty",
-            "Stamp Duty",
-            "Free-funds Interest",
-            "Free-funds Interest Tax",
-            "Impozitul reținut",
-        ]:
-            if (
-                len(self.cacheDict["dividends"]) > 0
-                and self.cacheDict["dividends"][-1]["date"] == transactDate
-                and self.cacheDict["dividends"][-1]["company"] == transactSymbol
-            ):
-                self.cacheDict["dividends"][-1]["value"] += value
-            else:
-                self.cacheDict["dividends"].append(
-                    {
-                        "date": transactDate,
-                        "fullDate": transactFullDate,
-                        "company": transactSymbol,
-                        "value": value,
-                    }
-                )
-        elif transactType in ["Deposit", "Depunere", "deposit"]:
-            fxRate = self.getFxRate(transactFullDate)
-            if (
-                len(self.cacheDict["deposits"]) > 0
-                and self.cacheDict["deposits"][-1]["date"] == transactDate
-            ):
-                self.cacheDict["deposits"][-1]["value"] += value
-                self.cacheDict["deposits"][-1]["value_ron"] += fxRate * value
-            else:
-                self.cacheDict["deposits"].append(
-                    {"date": transactDate, "value_ron": fxRate * value, "value": value}
-                )
-            self.cacheDict["deltaRows"].append(
-                {
-                    "action": (
-                        "DEPOSIT"
-                        if transactType in ["Deposit", "Depunere"]
-                        else "WITHDRAW"
-                    ),
-                    "amount": (
-                        value if transactType in ["Deposit", "Depunere"] else -value
-                    ),
-                    "fullDate": transactFullDate,
-                    "company": "USD",
-                    "value": "",
-                    "type": "FIAT",
-                }
-            )
-        elif transactType in ["tax RO", "SEC fee", "Sec Fee"]:
-            self.cacheDict["taxes_comissions"].append(
+        self.cacheDict["cashEvents"].append(
+            {"fullDate": transactFullDate, "value": value}
+        )
+        handler(
+            {
+                "action": action,
+                "type": transactType,
+                "date": transactDate,
+                "fullDate": transactFullDate,
+                "comment": transactComment,
+                "symbol": transactSymbol,
+                "value": value,
+            }
+        )
+
+    def handleXtbDividend(self, transactRow: dict):
+        action = transactRow["action"]
+        transactDate = transactRow["date"]
+        transactFullDate = transactRow["fullDate"]
+        transactSymbol = transactRow["symbol"]
+        value = transactRow["value"]
+        if (
+            len(self.cacheDict["dividends"]) > 0
+            and self.cacheDict["dividends"][-1]["date"] == transactDate
+            and self.cacheDict["dividends"][-1]["company"] == transactSymbol
+        ):
+            self.cacheDict["dividends"][-1]["value"] += value
+        else:
+            self.cacheDict["dividends"].append(
                 {
                     "date": transactDate,
-                    "value": value,
-                    "type": transactType,
-                    "moreInfo": transactComment,
-                }
-            )
-        elif transactType in [
-            "Stocks/ETF purchase",
-            "Acțiuni/Cumpărare ETF",
-            "Stock purchase",
-        ]:
-            self.cacheDict["deltaRows"].append(
-                {
-                    "action": "BUY",
-                    "amount": transactComment.split(" ")[2].split("/")[0],
                     "fullDate": transactFullDate,
-                    "company": deltaTickerHelper(transactSymbol),
-                    "value": -value,
-                    "type": deltaCompanyHelper(transactSymbol),
+                    "company": transactSymbol,
+                    "value": value,
                 }
             )
-        elif transactType in [
-            "Profit/Loss",
-            "Stocks/ETF sale",
-            "Vânzare acțiuni /ETF-uri",
-            "Profit/Pierdere",
-            "Stock sale",
-            "close trade",
-        ]:
-            # nothing to do yet
-            pass
+        self.addToTaxIndex(
+            transactDate,
+            transactSymbol,
+            xtbTaxCategories[action],
+            value,
+        )
+
+    def handleXtbDeposit(self, transactRow: dict):
+        action = transactRow["action"]
+        transactDate = transactRow["date"]
+        transactFullDate = transactRow["fullDate"]
+        value = transactRow["value"]
+        fxRate = self.getFxRate(transactFullDate)
+        if (
+            len(self.cacheDict["deposits"]) > 0
+            and self.cacheDict["deposits"][-1]["date"] == transactDate
+        ):
+            self.cacheDict["deposits"][-1]["value"] += value
+            self.cacheDict["deposits"][-1]["value_ron"] += fxRate * value
         else:
-            print(f"WARN: Unknown transaction type: {transactType}")
+            self.cacheDict["deposits"].append(
+                {"date": transactDate, "value_ron": fxRate * value, "value": value}
+            )
+        self.addDeltaRow(
+            {
+                "action": ("DEPOSIT" if action == "deposit" else "WITHDRAW"),
+                "amount": (value if action == "deposit" else -value),
+                "fullDate": transactFullDate,
+                "company": "USD",
+                "value": "",
+                "type": "FIAT",
+            }
+        )
+
+    def handleXtbFee(self, transactRow: dict):
+        transactType = transactRow["type"]
+        transactDate = transactRow["date"]
+        transactComment = transactRow["comment"]
+        transactSymbol = transactRow["symbol"]
+        value = transactRow["value"]
+        self.cacheDict["taxes_comissions"].append(
+            {
+                "date": transactDate,
+                "value": value,
+                "type": transactType,
+                "moreInfo": transactComment,
+            }
+        )
+        self.addToTaxIndex(
+            transactDate, transactSymbol or "USD", "taxes_comissions", value
+        )
+
+    def handleXtbBuy(self, transactRow: dict):
+        transactFullDate = transactRow["fullDate"]
+        transactComment = transactRow["comment"]
+        transactSymbol = transactRow["symbol"]
+        value = transactRow["value"]
+        self.addDeltaRow(
+            {
+                "action": "BUY",
+                "amount": transactComment.split(" ")[2].split("/")[0],
+                "fullDate": transactFullDate,
+                "company": deltaTickerHelper(transactSymbol),
+                "value": -value,
+                "type": deltaCompanyHelper(transactSymbol),
+            }
+        )
 
     ################# END XTB #######################
 
@@ -523,87 +957,208 @@ class InvestmentParser:
                 "closeValue": closeValue,
             }
         )
+        self.addToTaxIndex(
+            transactDateClose, transactSymbol, "sales", closeValue - openValue
+        )
 
     def handleEtoroAccActivityRow(self, row):
         try:
             transactID = row[8].value  # not all rows have transact ID
+            transactFullDate = etoroDateToDateTime(row[0].value)
+            balance = row[7].value  # balance reported after the transaction
+            firstBalanceRow = False
+            if isinstance(balance, (int, float)):
+                if len(self.cacheDict["balanceCheckpoints"]) > 0:
+                    lastBalance = self.cacheDict["balanceCheckpoints"][-1]["balance"]
+                else:
+                    # first row of the statement, the opening balance is its balance minus its own change
+                    lastBalance = balance
+                    firstBalanceRow = True
+                    self.cacheDict["openingBalance"] = balance
+                self.cacheDict["balanceCheckpoints"].append(
+                    {"fullDate": transactFullDate, "balance": balance}
+                )
             if (
                 transactID
                 and transactID != "-"
                 and (int(transactID) in etoroList) == ignore
             ):
+                # still moves the broker balance, take its change as is
+                if isinstance(balance, (int, float)):
+                    self.cacheDict["cashEvents"].append(
+                        {"fullDate": transactFullDate, "value": balance - lastBalance}
+                    )
                 return
             transactType = row[1].value
 
-            transactDate = extractDateFromDateTime(etoroDateToDateTime(row[0].value))
+            transactDate = extractDateFromDateTime(transactFullDate)
             # transactComment = row[4].value
             transactSymbol = (
                 row[2].value.split("/")[0] if row[2].value else ""
             )  # not all rows have a symbol
-            if transactType in [
-                "Interest Payment",
-            ]:
-                transactSymbol = "DOBANDA"
-                transactID = 0
             value = row[3].value
         except:
             print("WARN: An exception occurred")
             # maybe out of data range
             return
-        if transactType in ["Dividend", "Interest Payment"]:
-            if (
-                len(self.cacheDict["dividends"]) > 0
-                and self.cacheDict["dividends"][-1]["date"] == transactDate
-                and self.cacheDict["dividends"][-1]["company"] == transactSymbol
-            ):
-                self.cacheDict["dividends"][-1]["value"] += value
-            else:
-                self.cacheDict["dividends"].append(
-                    {
-                        "date": transactDate,
-                        "company": self.cacheDict["intermediarySales"][transactID],
-                        "value": value,
-                    }
-                )
-        elif transactType in ["Deposit"]:
-            fxRate = self.getFxRate(transactDate)
-            if (
-                len(self.cacheDict["deposits"]) > 0
-                and self.cacheDict["deposits"][-1]["date"] == transactDate
-            ):
-                self.cacheDict["deposits"][-1]["value"] += value
-                self.cacheDict["deposits"][-1]["value_ron"] += fxRate * value
-            else:
-                self.cacheDict["deposits"].append(
-                    {
-                        "date": transactDate,
-                        "value_ron": fxRate * value,
-                        "value": value,
-                    }  # value_ron for consistency, cant be calculated
-                )
-        elif transactType in ["Open Position", "Position closed"]:
-            self.cacheDict["intermediarySales"][transactID] = transactSymbol
-        elif transactType in ["Overnight fee"]:
-            self.cacheDict["taxes_comissions"].append(
+        transaction = self.classifyTransaction(transactType)
+        if transaction is None:
+            return
+        action, handler = transaction
+        if action in etoroCashFlows:
+            self.cacheDict["cashEvents"].append(
+                {"fullDate": transactFullDate, "value": etoroCashFlows[action] * value}
+            )
+            if firstBalanceRow:
+                self.cacheDict["openingBalance"] -= etoroCashFlows[action] * value
+        elif isinstance(balance, (int, float)):
+            self.cacheDict["cashEvents"].append(
+                {"fullDate": transactFullDate, "value": balance - lastBalance}
+            )
+        handler(
+            {
+                "action": action,
+                "type": transactType,
+                "id": transactID,
+                "date": transactDate,
+                "symbol": transactSymbol,
+                "value": value,
+            }
+        )
+
+    def handleEtoroDividend(self, transactRow: dict):
+        action = transactRow["action"]
+        transactID = transactRow["id"]
+        transactDate = transactRow["date"]
+        transactSymbol = transactRow["symbol"]
+        value = transactRow["value"]
+        if action == "interest":
+            transactSymbol = "DOBANDA"
+            transactID = 0
+        if (
+            len(self.cacheDict["dividends"]) > 0
+            and self.cacheDict["dividends"][-1]["date"] == transactDate
+            and self.cacheDict["dividends"][-1]["company"] == transactSymbol
+        ):
+            self.cacheDict["dividends"][-1]["value"] += value
+        else:
+            self.cacheDict["dividends"].append(
                 {
                     "date": transactDate,
+                    "company": self.cacheDict["intermediarySales"][transactID],
                     "value": value,
-                    "type": transactType,
-                    "moreInfo": "",
                 }
             )
-        elif transactType in [
-            "Start Copy",
-            "Stop Copy",
-            "corp action: Split",
-            "Adjustment",
-        ]:
-            pass
+        self.addToTaxIndex(
+            transactDate,
+            self.cacheDict["intermediarySales"][transactID],
+            "interest" if action == "interest" else "dividends",
+            value,
+        )
+
+    def handleEtoroDeposit(self, transactRow: dict):
+        transactDate = transactRow["date"]
+        value = transactRow["value"]
+        fxRate = self.getFxRate(transactDate)
+        if (
+            len(self.cacheDict["deposits"]) > 0
+            and self.cacheDict["deposits"][-1]["date"] == transactDate
+        ):
+            self.cacheDict["deposits"][-1]["value"] += value
+            self.cacheDict["deposits"][-1]["value_ron"] += fxRate * value
         else:
-            print(f"WARN: Unknown transaction type: {transactType}")
+            self.cacheDict["deposits"].append(
+                {
+                    "date": transactDate,
+                    "value_ron": fxRate * value,
+                    "value": value,
+                }  # value_ron for consistency, cant be calculated
+            )
+
+    def handleEtoroPosition(self, transactRow: dict):
+        transactID = transactRow["id"]
+        transactSymbol = transactRow["symbol"]
+        self.cacheDict["intermediarySales"][transactID] = transactSymbol
+
+    def handleEtoroFee(self, transactRow: dict):
+        transactType = transactRow["type"]
+        transactDate = transactRow["date"]
+        transactSymbol = transactRow["symbol"]
+        value = transactRow["value"]
+        self.cacheDict["taxes_comissions"].append(
+            {
+                "date": transactDate,
+                "value": value,
+                "type": transactType,
+                "moreInfo": "",
+            }
+        )
+        self.addToTaxIndex(
+            transactDate, transactSymbol or "USD", "taxes_comissions", value
+        )
 
     ################# END ETORO #######################
 
+    def addDeltaRow(self, row: dict):
+        self.cacheDict["deltaRows"].append(row)
+        if len(self.cacheDict["deltaRows"]) >= deltaRowBudget:
+            self.spillDeltaRows()
+
+    def spillDeltaRows(self):
+        # write the rows in memory as a run sorted by date, the runs are merged on export
+        run = tempfile.TemporaryFile("w+", newline="")
+        csv.writer(run).writerows(
+            self.formatDeltaRow(row)
+            for row in sorted(
+                self.cacheDict["deltaRows"], key=lambda row: row["fullDate"]
+            )
+        )
+        run.seek(0)
+        self.cacheDict["deltaRuns"].append(run)
+        self.cacheDict["deltaRows"] = []
+        if len(self.cacheDict["deltaRuns"]) >= deltaMergeFanIn:
+            self.mergeDeltaRuns()
+
+    def mergeDeltaRuns(self):
+        # merge the spilled runs into one, so no more than deltaMergeFanIn files are open at once
+        run = tempfile.TemporaryFile("w+", newline="")
+        try:
+            csv.writer(run).writerows(
+                heapq.merge(
+                    *[csv.reader(spilled) for spilled in self.cacheDict["deltaRuns"]],
+                    key=lambda row: row[0],
+                )
+            )
+        except:
+            run.close()
+            raise
+        run.seek(0)
+        self.closeDeltaRuns()
+        self.cacheDict["deltaRuns"] = [run]
+
+    def closeDeltaRuns(self):
+        for run in self.cacheDict["deltaRuns"]:
+            run.close()
+        self.cacheDict["deltaRuns"] = []
+
+    def formatDeltaRow(self, row: dict):
+        return [
+            row["fullDate"].strftime("%Y-%m-%d %H:%M:%S.%f+00:00"),
+            row["action"],
+            row["amount"],
+            row["company"],
+            row["type"],
+            row["value"],
+            "USD",
+            "",
+            "",
+            "",
+            "",
+            "",
+            self.type,
+            row["comment"] if "comment" in row else "",
+        ]
+
     def exportResult(self, filePrefix: str):
         # Dividend sheet
         sheet = self.resultXls["Dividends"]
@@ -673,6 +1228,45 @@ class InvestmentParser:
                 '_([$$-en-US]* #,##0.00_);_([$$-en-US]* (#,##0.00);_([$$-en-US]* "-"??_);_(@_)'
             )
 
+        # Tax summary sheet, one row per indexed group followed by the yearly totals
+        if self.missingFxRateDates:
+            print(
+                f"WARN: No FX rate for {len(self.missingFxRateDates)} dates, "
+                "their groups are left without a RON value in the tax summary"
+            )
+        sheet = self.resultXls["Tax Summary"]
+        sheet.append(["Year", "Company", "Category", "Value", "Value RON"])
+        summaryRows = [
+            [
+                year,
+                company,
+                category,
+                totals["value"],
+                "" if totals["value_ron"] is None else totals["value_ron"],
+            ]
+            for (year, company, category), totals in sorted(
+                self.taxIndex.items(),
+                key=lambda item: (item[0][0], str(item[0][1]), item[0][2]),
+            )
+        ] + [
+            [
+                year,
+                "TOTAL",
+                category,
+                totals["value"],
+                "" if totals["value_ron"] is None else totals["value_ron"],
+            ]
+            for (year, category), totals in sorted(self.taxYearTotals.items())
+        ]
+        for idx, row in enumerate(summaryRows, 2):
+            sheet.append(row)
+            sheet[f"D{idx}"].number_format = (
+                '_([$$-en-US]* #,##0.00_);_([$$-en-US]* (#,##0.00);_([$$-en-US]* "-"??_);_(@_)'
+            )
+            sheet[f"E{idx}"].number_format = (
+                '_-* #,##0.00 [$lei-ro-RO]_-;-* #,##0.00 [$lei-ro-RO]_-;_-* "-"?? [$lei-ro-RO]_-;_-@_-'
+            )
+
         # export parse result
         self.resultXls.save(
             f"exportFiles/{filePrefix}_investments_{datetime.datetime.now().strftime('%Y_%m_%d')}.xlsx"
@@ -699,25 +1293,19 @@ class InvestmentParser:
                     "Notes",
                 ]
             )
-            for row in self.cacheDict["deltaRows"]:
-                csvWriter.writerow(
+            # k-way merge of the spilled runs and the rows still in memory, the formatted dates sort as text
+            csvWriter.writerows(
+                heapq.merge(
+                    *[csv.reader(run) for run in self.cacheDict["deltaRuns"]],
                     [
-                        row["fullDate"].strftime("%Y-%m-%d %H:%M:%S.%f+00:00"),
-                        row["action"],
-                        row["amount"],
-                        row["company"],
-                        row["type"],
-                        row["value"],
-                        "USD",
-                        "",
-                        "",
-                        "",
-                        "",
-                        "",
-                        filePrefix,
-                        row["comment"] if "comment" in row else "",
-                    ]
+                        self.formatDeltaRow(row)
+                        for row in sorted(
+                            self.cacheDict["deltaRows"], key=lambda row: row["fullDate"]
+                        )
+                    ],
+                    key=lambda row: row[0],
                 )
+            )
 
 
 ################# DELTA #######################